@@ -9,6 +9,7 @@
 
 import json
 import socket
+import time
 import traceback
 
 from log import manage_log
@@ -17,6 +18,75 @@ from .load_balance import LoadBalance
 
 logger = manage_log.get_logger(__name__)
 
+_local_ip = None  # 本机ip，每个进程只计算一次
+
+
+def get_local_ip():
+    """获取本机ip，结果在进程内缓存。
+
+    优先取主机名解析到的、属于本机网卡的ip，其次取第一个非回环网卡的ip，
+    都取不到时再借助UDP socket(connect不会发包)，最后返回127.0.0.1。
+    """
+
+    global _local_ip
+    if _local_ip is None:
+        _local_ip = _discover_local_ip()
+    return _local_ip
+
+
+def _discover_local_ip():
+    interface_ips = _get_interface_ips()
+    try:
+        hostname_ips = {info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)}
+    except OSError:
+        hostname_ips = set()
+
+    for ip in interface_ips:
+        if ip in hostname_ips:
+            return ip
+    if interface_ips:
+        return interface_ips[0]
+    for ip in sorted(hostname_ips):
+        if not ip.startswith("127."):
+            return ip
+
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(("8.8.8.8", 53))
+            return s.getsockname()[0]
+        finally:
+            s.close()
+    except OSError:
+        return "127.0.0.1"
+
+
+def _get_interface_ips():
+    """获取本机网卡的ipv4地址，排除回环和链路本地地址，只支持linux，其它平台返回空列表。"""
+
+    try:
+        import fcntl
+        import struct
+        interfaces = socket.if_nameindex()
+    except (ImportError, AttributeError, OSError):
+        return []
+
+    ips = []
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in sorted(interfaces):
+            try:
+                packed = fcntl.ioctl(s.fileno(), 0x8915,  # SIOCGIFADDR
+                                     struct.pack("256s", name[:15].encode("utf-8")))
+            except OSError:
+                continue  # 网卡没有ipv4地址
+            ip = socket.inet_ntoa(packed[20:24])
+            if not ip.startswith("127.") and not ip.startswith("169.254."):
+                ips.append(ip)
+    finally:
+        s.close()
+    return ips
+
 
 class App(object):
     """实现具体的应用(server)。"""
@@ -31,8 +101,10 @@ class App(object):
         self._author = author
         self._name = name
         self._instances = {}
+        self._version = 0  # 实例集合或者实例信息变化时加1，负载均衡据此重新计算分组
+        self._fetched_at = None  # 最后一次从远端成功获取的时间(time.monotonic)
 
-        self.load_balance = LoadBalance(self)  # 实例化负载均衡对象
+        self.load_balance = LoadBalance(self, **author._load_balance_options)  # 实例化负载均衡对象
 
     def create_instance(self, instance_id=None, metadata={}, **kwargs):
         """创建一个服务实例。
@@ -51,6 +123,9 @@ class App(object):
                                     required to not crash the Spring Eureka UI,
                                     but otherwise not required. If not included -
                                     we will just use the server IP with '/info'。
+            :param registration_timestamp: float，单位秒，实例在eureka注册的时间戳。
+            :param zone: str，实例所在的可用区。
+            :param status: str，实例在eureka的状态。
             """
 
         if "weight" not in metadata:
@@ -66,6 +141,7 @@ class App(object):
 
     def update_instance(self, instance_id, **kwargs):
         instance = self._instances[instance_id]
+        before = self._routing_key(instance)
         instance._metadata = kwargs.get("metadata", instance._metadata)
         instance._lease_duration = kwargs.get("lease_duration", instance._lease_duration)
         instance._lease_renewal_interval = kwargs.get("lease_renewal_interval", instance._lease_renewal_interval)
@@ -74,6 +150,66 @@ class App(object):
         instance._hostname = kwargs.get("hostname", instance._hostname)
         instance._health_check_url = kwargs.get("health_check_url", instance._health_check_url)
         instance._status_page_url = kwargs.get("status_page_url", instance._status_page_url)
+        instance._registration_timestamp = kwargs.get("registration_timestamp", instance._registration_timestamp)
+        instance._zone = kwargs.get("zone", instance._zone)
+        instance._status = kwargs.get("status", instance._status)
+        if self._routing_key(instance) != before:
+            self._version += 1  # 只有影响路由的信息变化才让负载均衡重新分组
+
+    @staticmethod
+    def _routing_key(instance):
+        """影响负载均衡分组的实例信息：状态、可用区、权重和地址。"""
+
+        return (instance._status, instance._zone, instance._metadata.get("weight"),
+                instance._ip_addr, instance._port, instance._hostname)
+
+    def create_remote_instance(self, info):
+        """根据eureka返回的实例信息创建或者更新实例。
+
+        :param info: dict，eureka返回的instance信息。
+        :return: Instance对象。
+        """
+
+        return self.create_instance(
+            hostname=info["hostName"],
+            ip_addr=info["ipAddr"],
+            port=int(info["port"]["$"]),
+            instance_id=info["instanceId"],
+            metadata=info["metadata"],
+            lease_duration=int(info["leaseInfo"]["durationInSecs"]),
+            lease_renewal_interval=int(info["leaseInfo"]["renewalIntervalInSecs"]),
+            status_page_url=info["statusPageUrl"],
+            # health_check_url=info["healthCheckUrl"],
+            registration_timestamp=Instance.parse_timestamp(info["leaseInfo"].get("registrationTimestamp")),
+            zone=self._parse_zone(info),
+            status=info.get("status", "UP")
+        )
+
+    def sync_remote_instances(self, infos):
+        """用eureka返回的全部实例信息同步本地实例。
+
+        创建或者更新返回的实例，删除eureka上已经不存在的实例，本进程注册的实例不会被删除。
+
+        :param infos: list or dict，eureka返回的instance信息，只有一个实例时可能是dict。
+        :return:
+        """
+
+        if isinstance(infos, dict):
+            infos = [infos]
+        remote_ids = {self.create_remote_instance(info).instance_id for info in infos}
+        for instance in list(self._instances.values()):
+            if instance.instance_id not in remote_ids and not instance._is_register:
+                self.remove_instance(instance)
+                logger.ainfo("remove vanished instance: {}".format(instance.instance_id))
+
+    def _parse_zone(self, info):
+        """从metadata的zone key或者dataCenterInfo获取实例的可用区，获取不到返回None。"""
+
+        zone = (info.get("metadata") or {}).get(self._author._zone_metadata_key)
+        if zone:
+            return zone
+        data_center_metadata = (info.get("dataCenterInfo") or {}).get("metadata") or {}
+        return data_center_metadata.get("availability-zone")
 
     async def get_instance(self, instance_id, is_remote=False):
         """获取实例(service)。
@@ -87,17 +223,7 @@ class App(object):
             try:
                 url = "/apps/{}/{}".format(self._name, instance_id)
                 result = await self._author._do_req(url)
-                instance = result["instance"]
-                self.create_instance(hostname=instance["hostName"],
-                                     ip_addr=instance["ipAddr"],
-                                     port=int(instance["port"]["$"]),
-                                     instance_id=instance["instanceId"],
-                                     metadata=instance["metadata"],
-                                     lease_duration = int(instance["leaseInfo"]["durationInSecs"]),
-                                     lease_renewal_interval = int(instance["leaseInfo"]["renewalIntervalInSecs"]),
-                                     # health_check_url = instance["health_check_url"],
-                                     status_page_url = instance["statusPageUrl"]
-                )
+                self.create_remote_instance(result["instance"])
             except:
                 logger.adebug(traceback.format_exc())
         return self._instances.get(instance_id, None)
@@ -111,6 +237,7 @@ class App(object):
 
         self.remove_instance(instance)  # 如果instance存就删除，
         self._instances[instance.instance_id] = instance
+        self._version += 1
 
     def remove_instance(self, instance):
         """删除实例
@@ -121,6 +248,15 @@ class App(object):
 
         if instance.instance_id in self._instances:
             del self._instances[instance.instance_id]
+            self._version += 1
+
+    @property
+    def cache_age(self):
+        """本地缓存的年龄，单位秒，从没从远端获取过返回inf。"""
+
+        if self._fetched_at is None:
+            return float("inf")
+        return time.monotonic() - self._fetched_at
 
     def get_instance_ids(self):
         return sorted(self._instances.keys())
@@ -135,7 +271,8 @@ class Instance(object):
 
     def __init__(self, app, hostname=None, ip_addr=None, port=8080, instance_id=None, metadata={},
                  lease_duration=30, lease_renewal_interval=10,
-                 health_check_url=None, status_page_url=None):
+                 health_check_url=None, status_page_url=None, registration_timestamp=None,
+                 zone=None, status="UP"):
         """
         :param app: App对象。
         :param hostname: str，被注册服务实例的主机名。
@@ -151,6 +288,9 @@ class Instance(object):
                                 required to not crash the Spring Eureka UI,
                                 but otherwise not required. If not included -
                                 we will just use the server IP with '/info'。
+        :param registration_timestamp: float，单位秒，实例在eureka注册的时间戳，用于慢启动。
+        :param zone: str，实例所在的可用区，用于就近路由。
+        :param status: str，实例在eureka的状态，取值参考StatusType。
         """
 
         self._app = app
@@ -165,6 +305,11 @@ class Instance(object):
         self._hostname = hostname or self._ip_addr
         self._instance_id = instance_id
         self._health_check_url = health_check_url
+        self._registration_timestamp = registration_timestamp
+        self._first_seen = time.time()  # 本地第一次看到该实例的时间
+        self._zone = zone
+        self._status = status
+        self.active_requests = 0  # 正在处理的请求数，用于感知负载
 
         if "weight" not in self._metadata:
             self._metadata["weight"] = 1   # 设置默认权重为1
@@ -183,11 +328,31 @@ class Instance(object):
     def get_local_ip(self):
         """获取本机ip。"""
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 53))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
+        return get_local_ip()
+
+    @staticmethod
+    def parse_timestamp(timestamp):
+        """把eureka返回的毫秒时间戳转成秒，0或者空表示没有。"""
+
+        if not timestamp:
+            return None
+        return int(timestamp) / 1000
+
+    @property
+    def start_time(self):
+        """实例开始接收流量的时间，优先用注册时间戳，否则用本地第一次看到的时间。
+
+        注册时间戳是eureka服务端的时钟，比本地时间还晚说明时钟有偏差，这时也用本地第一次看到的时间。
+        """
+
+        timestamp = self._registration_timestamp
+        if not timestamp or timestamp > time.time():
+            return self._first_seen
+        return timestamp
+
+    @property
+    def is_up(self):
+        return self._status == "UP"
 
     def _update_meta(self, key, value):
         self._metadata[key] = value
@@ -213,5 +378,8 @@ class Instance(object):
             "_hostname": self._hostname,
             "_instance_id": self.instance_id,
             "_health_check_url": self._health_check_url,
-            "_status_page_url": self._status_page_url
+            "_status_page_url": self._status_page_url,
+            "_registration_timestamp": self._registration_timestamp,
+            "_zone": self._zone,
+            "_status": self._status
         }, indent=4)
\ No newline at end of file
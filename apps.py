@@ -7,9 +7,14 @@
 """该模块实现服务的注册和发现接口。"""
 
 
+import asyncio
 import enum
+import time
 
 from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from .cache import ResponseCache
+from .exc import NoInstanceException
+from .limiter import AdaptiveLimiter
 
 
 class Strategy(enum.Enum):
@@ -41,6 +46,16 @@ class RegisterApp(object):
 
         return self._driver.register(instance, *args, **kwargs)
 
+    async def register_instances(self, instances, concurrency=10):
+        """并发注册多个instance。
+
+        :param instances: list，要被注册的服务实例对象列表。
+        :param concurrency: int，最大并发请求数。
+        :return: dict，{"succeeded": [instance_id], "failed": {instance_id: 错误信息}}。
+        """
+
+        return await self._driver.register_many(instances, concurrency)
+
     async def deregister_instance(self, instance, *args, **kwargs):
         """注销instance。
 
@@ -49,6 +64,16 @@ class RegisterApp(object):
 
         return await self._driver.deregister(instance, *args, **kwargs)
 
+    async def deregister_instances(self, instances, concurrency=10):
+        """并发注销多个instance。
+
+        :param instances: list，要被注销的服务实例对象列表。
+        :param concurrency: int，最大并发请求数。
+        :return: dict，{"succeeded": [instance_id], "failed": {instance_id: 错误信息}}。
+        """
+
+        return await self._driver.deregister_many(instances, concurrency)
+
     async def update_meta(self, instance, key, value):
         """更新instance的元数据。
 
@@ -62,6 +87,18 @@ class RegisterApp(object):
 
         return await self._driver.update_meta(instance, key, value)
 
+    async def update_metas(self, instance, metadata):
+        """在一次请求里更新instance的多个元数据。
+
+        远端更新成功后才更新本地元数据，失败抛出异常并且本地元数据不变。
+
+        :param instance: 要被更新元数据的实例对象。
+        :param metadata: dict，要更新的元数据。
+        :return:
+        """
+
+        return await self._driver.update_metas(instance, metadata)
+
     def create_app(self, app_name):
         """创建app。"
 
@@ -81,19 +118,25 @@ class DiscoverApp(object):
 
     _driver = None  # 注册、发现服务的驱动对象或者客户端对象。
 
-    def __init__(self, app_name=None, strategy=Strategy._random, protocol="http"):
+    def __init__(self, app_name=None, strategy=Strategy._random, protocol="http", limiter=None, cache=None):
         """
         :param app_name: str，应用名字。
         :param strategy: 是个枚举值，取值范围参考Strategy的属性。
         :param protocol: str，http或者https。
+        :param limiter: AdaptiveLimiter，该应用的并发限制器，None表示不限制。
+        :param cache: ResponseCache，GET请求的响应缓存，提供后相同的并发GET请求只发一次，None表示不缓存。
         """
 
         self._app_name = app_name
         self._strategy_func = strategy.value
         assert protocol in ("http", "https"), "protocol must be 'http' or 'https'"
         self._protocol = protocol
-        self._session = ClientSession(timeout=ClientTimeout(connect=2, sock_connect=1, sock_read=2),
-                                      connector=TCPConnector(limit=1024))
+        self._session = None  # 第一次请求时创建，避免在事件循环外创建会话和连接器
+        assert limiter is None or isinstance(limiter, AdaptiveLimiter), "limiter type error"
+        self._limiter = limiter
+        assert cache is None or isinstance(cache, ResponseCache), "cache type error"
+        self._cache = cache
+        self._inflight = {}  # 正在进行的GET请求，缓存key -> Task，用于合并相同请求
 
     @classmethod
     def set_driver(cls, driver):
@@ -109,6 +152,34 @@ class DiscoverApp(object):
         assert isinstance(session, ClientSession), "session type error"
         self._session = session
 
+    @property
+    def session(self):
+        """http会话对象，第一次使用时在当前事件循环中创建。"""
+
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(timeout=ClientTimeout(connect=2, sock_connect=1, sock_read=2),
+                                          connector=TCPConnector(limit=1024))
+        return self._session
+
+    async def close(self):
+        """关闭http会话。"""
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def limiter(self):
+        """并发限制器，可以通过limiter.stats查看当前限制值、在途请求数和拒绝数，没设置时为None。"""
+
+        return self._limiter
+
+    @property
+    def cache(self):
+        """响应缓存，可以通过cache.stats查看命中、合并和淘汰次数。"""
+
+        return self._cache
+
     async def request(self, path=None, method="GET", is_hostname=False, **kwargs):
         """
 
@@ -117,20 +188,76 @@ class DiscoverApp(object):
         :param is_hostname: bool，如果为True，会按主键名字拼接地址，否则按ip拼接地址。
         :param kwargs: 包括http协议常用字段。
         :return:
+
+        设置了limiter时，超过该应用的并发限制并且排队失败时抛出LimitExceededException，
+        应用没有可用实例时抛出NoInstanceException。
+        设置了cache时，GET请求优先读缓存，相同的并发GET请求合并成一个发到下游。
+        """
+
+        if self._cache is None or method.upper() != "GET" or self._cache.is_bypass(kwargs.get("headers")):
+            status, result, _ = await self._request(path, method, is_hostname, **kwargs)
+            return status, result
+
+        key = self._cache.make_key(self._app_name, path, is_hostname, kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        task = self._inflight.get(key, None)
+        if task is None:
+            self._cache.record_miss()
+            task = asyncio.ensure_future(self._request_and_cache(key, path, is_hostname, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self._cache.record_coalesced()
+        return await asyncio.shield(task)  # 某个调用方被取消不影响其它等待同一请求的调用方
+
+    async def _request_and_cache(self, key, path, is_hostname, **kwargs):
+        status, result, headers = await self._request(path, "GET", is_hostname, **kwargs)
+        self._cache.put(key, status, result, headers)
+        return status, result
+
+    async def _request(self, path, method, is_hostname, **kwargs):
+        """选择实例并发送请求。
+
+        :return: (status, result, headers)
         """
 
         app  = await self.get_app(self._app_name)  # 获取应用
+        if app is None:
+            raise NoInstanceException("app {} not found".format(self._app_name))
         load_blance_func = getattr(app.load_balance, self._strategy_func)  # 拿到负载均衡实例的函数
-        instance = load_blance_func()  # 获取实例
+        instance = load_blance_func()  # 获取实例，没有实例时抛出NoInstanceException
         if is_hostname:
             addr = "{}:{}".format(instance._hostname, instance._port)  # 根据主机名获取地址
         else:
             addr = "{}:{}".format(instance._ip_addr, instance._port)  # 根据ip获取地址
         url = "{}://{}/{}".format(self._protocol, addr, path.lstrip("/"))  # 拼接url
-        async with self._session.request(method=method.upper(), url=url, **kwargs) as resp:
-            result = await resp.text()
-            status = resp.status
-            return status, result
+
+        if self._limiter is not None:
+            await self._limiter.acquire()  # 获取并发名额，获取不到会抛出LimitExceededException
+        start = time.monotonic()
+        dropped = True
+        cancelled = False
+        instance.active_requests += 1
+        try:
+            async with self.session.request(method=method.upper(), url=url, **kwargs) as resp:
+                result = await resp.text()
+                status = resp.status
+                dropped = status in (429, 503)  # 下游明确表示过载
+                return status, result, resp.headers
+        except asyncio.CancelledError:
+            cancelled = True  # 调用方自己取消，和下游是否过载无关
+            raise
+        finally:
+            instance.active_requests -= 1
+            if self._limiter is None:
+                pass
+            elif cancelled:
+                self._limiter.cancel()
+            else:
+                self._limiter.release(time.monotonic() - start, dropped=dropped)
 
     async def get_app(self, app_name, is_remote=False):
         """根据应用名字获取app。
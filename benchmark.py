@@ -0,0 +1,48 @@
+# -*- coding  :   utf-8 -*-
+# @Author     :   zhaojiangbing
+# @File       :   benchmark.py
+# @Software   :   PyCharm
+
+
+"""测量导入包、创建客户端和创建大量实例的耗时。
+
+用法：python benchmark.py [实例数]
+"""
+
+
+import importlib
+import os
+import sys
+import time
+
+
+def main(instance_count=1000):
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(here))
+
+    start = time.perf_counter()
+    package = importlib.import_module(os.path.basename(here))  # 按包导入，包内用的是相对导入
+    client_module = importlib.import_module(package.__name__ + ".client")
+    apps_module = importlib.import_module(package.__name__ + ".apps")
+    import_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    eureka = client_module.EurekaClient(eureka_urls="http://127.0.0.1:8765")
+    apps_module.DiscoverApp.set_driver(eureka)
+    apps_module.DiscoverApp(app_name="benchmark")
+    construct_time = time.perf_counter() - start
+
+    app = eureka.create_app("benchmark")
+    start = time.perf_counter()
+    for port in range(instance_count):
+        app.create_instance(port=10000 + port, metadata={})  # 不提供ip，走本机ip发现
+    instance_time = time.perf_counter() - start
+
+    print("import:            {:.2f} ms".format(import_time * 1000))
+    print("construct client:  {:.2f} ms".format(construct_time * 1000))
+    print("create {} instances: {:.2f} ms ({:.1f} us/instance)".format(
+        instance_count, instance_time * 1000, instance_time * 1e6 / instance_count))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
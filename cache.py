@@ -0,0 +1,138 @@
+# -*- coding  :   utf-8 -*-
+# @Author     :   zhaojiangbing
+# @File       :   cache.py
+# @Software   :   PyCharm
+
+
+"""实现GET请求的响应缓存。"""
+
+
+import collections
+import json
+import re
+import time
+
+
+_MAX_AGE_RE = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)\"?", re.IGNORECASE)
+
+
+class ResponseCache(object):
+    """按字节数限制大小的LRU响应缓存。
+
+    只缓存状态码为200的响应，过期时间取响应头Cache-Control的max-age，没有就用default_ttl，
+    响应头为no-store或no-cache时不缓存。
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, default_ttl=1):
+        """
+        :param max_bytes: int，缓存的最大字节数，超过就淘汰最久没用的响应。
+        :param default_ttl: float，单位秒，响应没有指定max-age时的缓存时间。
+        """
+
+        self._max_bytes = max_bytes
+        self._default_ttl = default_ttl
+        self._entries = collections.OrderedDict()  # key -> (expires_at, size, status, result)
+        self._bytes = 0
+        self._counts = collections.Counter()  # hit、miss、coalesced、store、evict
+
+    @property
+    def stats(self):
+        stats = dict(self._counts)
+        stats.update({"entries": len(self._entries), "bytes": self._bytes})
+        return stats
+
+    @staticmethod
+    def make_key(app_name, path, is_hostname, kwargs):
+        """根据应用、path和请求参数生成缓存key。"""
+
+        return json.dumps([app_name, path.lstrip("/"), is_hostname, kwargs], sort_keys=True, default=str)
+
+    @staticmethod
+    def is_bypass(headers):
+        """请求头要求不走缓存时返回True。"""
+
+        cache_control = _get_header(headers, "Cache-Control")
+        return "no-cache" in cache_control or "no-store" in cache_control
+
+    def get(self, key):
+        """获取没过期的缓存，没有返回None，未命中由调用方在真正发起请求时用record_miss记录。
+
+        :param key: str，缓存key。
+        :return: (status, result) or None。
+        """
+
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return None
+        expires_at, size, status, result = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)  # 最近使用
+        self._counts["hit"] += 1
+        return status, result
+
+    def record_miss(self):
+        """记录一次未命中，也就是一次发到下游的请求。"""
+
+        self._counts["miss"] += 1
+
+    def record_coalesced(self):
+        """记录一次被合并的请求。"""
+
+        self._counts["coalesced"] += 1
+
+    def put(self, key, status, result, headers=None):
+        """缓存响应。
+
+        :param key: str，缓存key。
+        :param status: int，http状态码。
+        :param result: str，响应内容。
+        :param headers: 响应头。
+        :return:
+        """
+
+        if status != 200:
+            return
+        ttl = self._get_ttl(headers)
+        size = len(key) + len(result.encode("utf-8"))
+        if ttl <= 0 or size > self._max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, size, status, result)
+        self._bytes += size
+        self._counts["store"] += 1
+        while self._bytes > self._max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._counts["evict"] += 1
+
+    def _get_ttl(self, headers):
+        cache_control = _get_header(headers, "Cache-Control")
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            return 0
+        match = _MAX_AGE_RE.search(cache_control)
+        if match:
+            return int(match.group(1))
+        return self._default_ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+
+def _get_header(headers, name):
+    """大小写不敏感地获取头部的值，返回小写字符串。"""
+
+    if not headers:
+        return ""
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return str(value).lower()
+    return ""
@@ -11,8 +11,12 @@ import traceback
 import json
 import enum
 import asyncio
+import collections
+import socket
+import time
 
 from http import HTTPStatus
+from urllib.parse import urlencode
 from .exc import EurekaException
 from aiohttp import ClientSession, ClientTimeout
 from log import manage_log
@@ -38,25 +42,77 @@ class StatusType(enum.Enum):
 class EurekaClient(object):
     """实现eureka客户端。"""
 
-    def __init__(self, eureka_urls="http://localhost:8765", long_poll_interval=5, loop=None, timeout=60):
+    def __init__(self, eureka_urls="http://localhost:8765", long_poll_interval=5, loop=None, timeout=60,
+                 slow_start_window=0, slow_start_min_ratio=0.1, zone=None, zone_metadata_key="zone",
+                 zone_min_healthy_ratio=0.7, zone_max_load=None, cache_ttl=30, cache_max_stale=300,
+                 client_id=None, subset_size=None, panic_threshold=0.5):
         """
         :param eureka_urls: str, eureka服务集群列表，用逗号隔开。
         :param long_poll_interval: int，单位秒，长轮询更新本地缓存。
         :param loop: 事件循环对象。
         :param timeout: int，单位秒，http请求超时总时间。
+        :param slow_start_window: int，单位秒，新实例的权重在这个时间内从小比例逐渐升到metadata的weight，0表示不启用。
+        :param slow_start_min_ratio: float，慢启动开始时实例权重占metadata的weight的比例。
+        :param zone: str，本客户端所在的可用区，设置后只路由到同可用区的实例，None表示不区分可用区。
+        :param zone_metadata_key: str，实例metadata中表示可用区的key，没有时取dataCenterInfo的availability-zone。
+        :param zone_min_healthy_ratio: float，本可用区UP实例占比低于这个值时，流量溢出到其它可用区。
+        :param zone_max_load: float，本可用区实例平均在途请求数超过这个值时，流量溢出到其它可用区，None表示不检查。
+        :param cache_ttl: float，单位秒，本地缓存的app在这个时间内是新鲜的，直接返回。
+        :param cache_max_stale: float，单位秒，缓存超过cache_ttl但没超过这个值时直接返回并后台刷新，
+                                超过这个值就阻塞等待刷新。
+        :param client_id: int or str，用于确定性子集划分，要求重启后不变。整数表示客户端序号(如pod序号)，
+                          各实例负载严格均衡；字符串按rendezvous hashing划分，默认是主机名。
+                          同一主机上有多个进程时应为每个进程指定不同的值。
+        :param subset_size: int，每个app只使用按client_id选出的这么多个实例，None表示使用全部实例。
+        :param panic_threshold: float，app的UP实例占比低于这个值时，负载均衡不再过滤状态，使用全部实例。
         """
 
         self._eureka_urls = eureka_urls.split(",")
         self._eureka_url = self._eureka_urls[0]
         self._long_poll_interval = long_poll_interval
         self._not_add_long_poll = True
-        self._loop = loop or asyncio.get_event_loop()
+        self._loop = loop  # 没提供就在使用时取当前事件循环
         self._apps = {}  # 存放创建的app
         self._num = 0
-        self._session = ClientSession(
-            headers={"Accept": "application/json", "Content-Type": "application/json"},
-            timeout=ClientTimeout(total=timeout)
-        )
+        self._zone_metadata_key = zone_metadata_key
+        self._load_balance_options = {  # 创建app时传给负载均衡对象的参数
+            "slow_start_window": slow_start_window,
+            "slow_start_min_ratio": slow_start_min_ratio,
+            "zone": zone,
+            "zone_min_healthy_ratio": zone_min_healthy_ratio,
+            "zone_max_load": zone_max_load,
+            "client_id": socket.gethostname() if client_id is None else client_id,
+            "subset_size": subset_size,
+            "panic_threshold": panic_threshold,
+        }
+        self._cache_policy = (cache_ttl, cache_max_stale)  # 默认缓存策略
+        self._cache_policies = {}  # 按app设置的缓存策略，app_name -> (ttl, max_stale)
+        self._refreshing = {}  # 正在刷新的任务，app_name -> Task，保证每个app同时只有一个刷新
+        self._cache_counts = collections.Counter()  # 缓存读取计数：fresh、stale、blocking、miss
+        self._timeout = timeout
+        self._session = None  # 第一次请求时创建
+
+    @property
+    def loop(self):
+        return self._loop or asyncio.get_event_loop()
+
+    @property
+    def session(self):
+        """http会话对象，第一次使用时在当前事件循环中创建。"""
+
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                headers={"Accept": "application/json", "Content-Type": "application/json"},
+                timeout=ClientTimeout(total=self._timeout)
+            )
+        return self._session
+
+    async def close(self):
+        """关闭http会话。"""
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     @property
     def number(self):
@@ -97,10 +153,44 @@ class EurekaClient(object):
         if app._name in self._apps:
             del self._apps[app._name]
 
+    def set_cache_policy(self, app_name, ttl, max_stale):
+        """设置某个app的缓存策略。
+
+        :param app_name: str，app名字。
+        :param ttl: float，单位秒，新鲜时间。
+        :param max_stale: float，单位秒，最大陈旧时间，必须不小于ttl。
+        :return:
+        """
+
+        assert 0 <= ttl <= max_stale, "cache policy must be 0 <= ttl <= max_stale"
+        self._cache_policies[app_name] = (ttl, max_stale)
+
+    def get_cache_age(self, app_name):
+        """获取app本地缓存的年龄。
+
+        :param app_name: str，app名字。
+        :return: float，单位秒，没有缓存返回None。
+        """
+
+        app = self._apps.get(app_name, None)
+        return app.cache_age if app else None
+
+    @property
+    def cache_stats(self):
+        """缓存指标，包括各类读取次数和每个app的缓存年龄。"""
+
+        return {
+            "counts": dict(self._cache_counts),
+            "ages": {app_name: app.cache_age for app_name, app in self._apps.items()},
+            "refreshing": sorted(self._refreshing.keys()),
+        }
+
     async def get_app(self, app_name, is_remote=False):
         """获取app。
 
         该方法会调用_long_poll方法，启动长轮询，实时更新本地缓存。
+        缓存年龄在ttl内直接返回；超过ttl没超过max_stale直接返回并后台刷新；
+        超过max_stale、本地没有或者is_remote为True时阻塞等待刷新。
 
         :param app_name: str，app名字。
         :param is_remote: bool，是否从远端获取。
@@ -108,11 +198,42 @@ class EurekaClient(object):
         """
 
         if self._not_add_long_poll:
-            self._loop.create_task(self._long_poll())  # # 启动长轮询，实时更新本地缓存。
-        if app_name not in self._apps or is_remote == True:
-            await self._get_remote_app(app_name)  # 从远端获取app，会缓存到本地。
+            self._not_add_long_poll = False
+            self.loop.create_task(self._long_poll())  # # 启动长轮询，实时更新本地缓存。
+
+        app = self._apps.get(app_name, None)
+        if app is None or is_remote == True:
+            self._cache_counts["miss"] += 1
+            await asyncio.shield(self._refresh_app(app_name))  # 从远端获取app，会缓存到本地。
+            return self._apps.get(app_name, None)
+
+        ttl, max_stale = self._cache_policies.get(app_name, self._cache_policy)
+        age = app.cache_age
+        if age <= ttl:
+            self._cache_counts["fresh"] += 1
+        elif age <= max_stale:
+            self._cache_counts["stale"] += 1
+            self._refresh_app(app_name)  # 后台刷新，不等待
+        else:
+            self._cache_counts["blocking"] += 1
+            logger.ainfo("app {} cache is {:.1f}s old, refresh blocking".format(app_name, age))
+            await asyncio.shield(self._refresh_app(app_name))
         return self._apps.get(app_name, None)
 
+    def _refresh_app(self, app_name):
+        """刷新app，同一个app正在刷新时复用正在进行的任务。
+
+        :param app_name: str，app名字。
+        :return: Task对象。
+        """
+
+        task = self._refreshing.get(app_name, None)
+        if task is None:
+            task = self.loop.create_task(self._get_remote_app(app_name))
+            self._refreshing[app_name] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(app_name, None))
+        return task
+
     async def _get_remote_app(self, app_name):
         """从远端获取app。
 
@@ -123,19 +244,15 @@ class EurekaClient(object):
         url = "/apps/{}".format(app_name)
         app = self.create_app(app_name)  # 从远端获取app就得创建app
         try:
-            result = await self._do_req(url)
-            for instance in result["application"]["instance"]:
-                app.create_instance(
-                    hostname=instance["hostName"],
-                    ip_addr=instance["ipAddr"],
-                    port=int(instance["port"]["$"]),
-                    instance_id=instance["instanceId"],
-                    metadata=instance["metadata"],
-                    lease_duration=int(instance["leaseInfo"]["durationInSecs"]),
-                    lease_renewal_interval=int(instance["leaseInfo"]["renewalIntervalInSecs"]),
-                    status_page_url=instance["statusPageUrl"]
-                    # health_check_url=None
-                )
+            try:
+                result = await self._do_req(url, raise_exc=True)
+                instances = result["application"]["instance"]
+            except EurekaException as e:
+                if e.status != HTTPStatus.NOT_FOUND or app_name not in self._apps:
+                    raise  # 不认识的app返回404时，不缓存、不轮询，返回None
+                instances = []  # 已知app的实例都下线了，eureka返回404
+            app.sync_remote_instances(instances)  # 新增、更新、删除实例
+            app._fetched_at = time.monotonic()  # 记录缓存时间
             self.add_app(app)  # 添加app
             return app
         except:
@@ -158,7 +275,7 @@ class EurekaClient(object):
         return None
 
     def register(self, instance):
-        self._loop.create_task(self._register_(instance))
+        self.loop.create_task(self._register_(instance))
 
     async def _register_(self, instance):
         """注册service实例。
@@ -167,54 +284,119 @@ class EurekaClient(object):
         :return:
         """
 
+        result = None
         if not instance._is_register:
-            instance._is_register = True
             try:
-                payload = {
-                    "instance": {
-                        "instanceId": instance.instance_id,
-                        "leaseInfo": {
-                            "durationInSecs": instance._lease_duration,
-                            "renewalIntervalInSecs": instance._lease_renewal_interval,
-                        },
-                        "port": {
-                            "$": instance._port,
-                            "@enabled": instance._port is not None,
-                        },
-                        "hostName": instance._hostname,
-                        "app": instance._app._name,
-                        "ipAddr": instance._ip_addr,
-                        "vipAddress": instance._app._name,
-                        "dataCenterInfo": {
-                            "@class": "com.netflix.appinfo.MyDataCenterInfo",
-                            "name": "MyOwn",
-                        },
-                    }
-                }
-                if instance._health_check_url is not None:
-                    payload['instance']['healthCheckUrl'] = instance._health_check_url
-                if instance._status_page_url is not None:
-                    payload['instance']['statusPageUrl'] = instance._status_page_url
-                if instance._metadata:
-                    payload['instance']['metadata'] = instance._metadata
-
-                url = "/apps/{}".format(instance._app._name)
-                result = await self._do_req(url, method="POST", data=json.dumps(payload))  # 注册到远端
-                logger.ainfo("register instance: {}".format(instance._str_))  # 打印注册的实列
-
+                result = await self._register_remote(instance)
                 await self._heartbeat(instance)  # 启动心跳
             except:
-                instance._is_register = False
                 logger.ainfo(traceback.format_exc())
 
         return result
 
+    async def _register_remote(self, instance):
+        """把service实例注册到远端，失败抛出异常。
+
+        :param instance: Instance，service实例对象。
+        :return:
+        """
+
+        instance._is_register = True
+        instance._is_heartbeat = True  # 注销过的实例重新注册时要恢复心跳
+        try:
+            payload = {
+                "instance": {
+                    "instanceId": instance.instance_id,
+                    "leaseInfo": {
+                        "durationInSecs": instance._lease_duration,
+                        "renewalIntervalInSecs": instance._lease_renewal_interval,
+                    },
+                    "port": {
+                        "$": instance._port,
+                        "@enabled": instance._port is not None,
+                    },
+                    "hostName": instance._hostname,
+                    "app": instance._app._name,
+                    "ipAddr": instance._ip_addr,
+                    "vipAddress": instance._app._name,
+                    "dataCenterInfo": {
+                        "@class": "com.netflix.appinfo.MyDataCenterInfo",
+                        "name": "MyOwn",
+                    },
+                }
+            }
+            if instance._health_check_url is not None:
+                payload['instance']['healthCheckUrl'] = instance._health_check_url
+            if instance._status_page_url is not None:
+                payload['instance']['statusPageUrl'] = instance._status_page_url
+            if instance._metadata:
+                payload['instance']['metadata'] = instance._metadata
+
+            url = "/apps/{}".format(instance._app._name)
+            result = await self._do_req(url, method="POST", data=json.dumps(payload), raise_exc=True)  # 注册到远端
+            logger.ainfo("register instance: {}".format(instance._str_))  # 打印注册的实列
+            return result
+        except:
+            instance._is_register = False
+            raise
+
+    async def register_many(self, instances, concurrency=10):
+        """并发注册多个service实例，注册成功的实例会启动心跳。
+
+        :param instances: list，Instance对象列表。
+        :param concurrency: int，最大并发请求数。
+        :return: dict，{"succeeded": [instance_id], "failed": {instance_id: 错误信息}}。
+        """
+
+        async def register(instance):
+            if not instance._is_register:
+                await self._register_remote(instance)
+                self.loop.create_task(self._heartbeat(instance))  # 启动心跳
+
+        return await self._bulk(register, instances, concurrency)
+
     async def deregister(self, instance):
         """注销应用实例。"""
 
         instance._is_heartbeat = False  # 取消心跳
         url = "/apps/{}/{}".format(instance._app._name, instance.instance_id)
-        return await self._do_req(url, method="DELETE")
+        result = await self._do_req(url, method="DELETE")
+        if result is not None:
+            instance._is_register = False  # 注销成功，可以重新注册，也可以被同步删除
+        return result
+
+    async def deregister_many(self, instances, concurrency=10):
+        """并发注销多个应用实例。
+
+        :param instances: list，Instance对象列表。
+        :param concurrency: int，最大并发请求数。
+        :return: dict，{"succeeded": [instance_id], "failed": {instance_id: 错误信息}}。
+        """
+
+        async def deregister(instance):
+            url = "/apps/{}/{}".format(instance._app._name, instance.instance_id)
+            await self._do_req(url, method="DELETE", raise_exc=True)
+            instance._is_heartbeat = False  # 远端注销成功后才取消心跳，失败时实例继续续约
+            instance._is_register = False
+
+        return await self._bulk(deregister, instances, concurrency)
+
+    async def _bulk(self, func, instances, concurrency):
+        """用有限的并发对多个实例执行func，汇总每个实例的结果。"""
+
+        semaphore = asyncio.Semaphore(concurrency)
+        summary = {"succeeded": [], "failed": {}}
+
+        async def run(instance):
+            async with semaphore:
+                try:
+                    await func(instance)
+                    summary["succeeded"].append(instance.instance_id)
+                except Exception as e:
+                    summary["failed"][instance.instance_id] = repr(e)
+
+        await asyncio.gather(*[run(instance) for instance in instances])
+        return summary
 
     async def set_status_override(self, instance, status: StatusType):
         """Sets the status override, note: this should generally only
@@ -247,11 +429,25 @@ class EurekaClient(object):
         :return:
         """
 
-        url = "/apps/{}/{}/metadata?{}={}".format(instance._app._name,
-                                                  instance.instance_id,
-                                                  key, value)
-        result = await self._do_req(url, method="PUT")  # 更新远程
-        instance._update_meta(key, value)  # 更新本地
+        try:
+            return await self.update_metas(instance, {key: value})
+        except Exception:
+            return None  # 错误已经在_do_req里记录
+
+    async def update_metas(self, instance, metadata):
+        """在一次请求里更新instance的多个元数据，远端更新成功后才更新本地，失败抛出异常。
+
+        :param instance: Instance，实例对象。
+        :param metadata: dict，要更新的元数据。
+        :return:
+        """
+
+        url = "/apps/{}/{}/metadata?{}".format(instance._app._name,
+                                               instance.instance_id,
+                                               urlencode(metadata))
+        result = await self._do_req(url, method="PUT", raise_exc=True)  # 更新远程
+        for key, value in metadata.items():
+            instance._update_meta(key, value)  # 更新本地
         return result
 
     async def _get_remote_apps(self):
@@ -272,18 +468,19 @@ class EurekaClient(object):
         url = "/vips/{}".format(svip_address)
         return await self._do_req(url)
 
-    async def _do_req(self, path, method="GET", data=None):
+    async def _do_req(self, path, method="GET", data=None, raise_exc=False):
         """http 请求方法。
 
         :param path: str，url path。
         :param method: str，http方法。
         :param data: json，请求的携带数据。
+        :param raise_exc: bool，为True时请求失败抛出异常，否则返回None。
         :return:
         """
 
         url = self._eureka_url + path
         try:
-            async with self._session.request(method, url, data=data) as resp:
+            async with self.session.request(method, url, data=data) as resp:
                 if 400 <= resp.status < 600:
                     status = resp.status
                     result = await resp.text()
@@ -297,6 +494,8 @@ class EurekaClient(object):
         except Exception as e:
             self._eureka_url = self._eureka_urls[self.number]
             logger.ainfo(traceback.format_exc())
+            if raise_exc:
+                raise
 
     async def _heartbeat(self, instance):
         """应用实例和eureka server 保持心跳。
@@ -319,7 +518,7 @@ class EurekaClient(object):
         self._not_add_long_poll = False  # 保证不重复启动长轮询
         while True:
             for app_name in list(self._apps.keys()):
-                await self._get_remote_app(app_name)
+                await asyncio.shield(self._refresh_app(app_name))
             logger.adebug("{} long poll".format(self._eureka_url))
             await asyncio.sleep(self._long_poll_interval)
 
@@ -14,4 +14,11 @@ class EurekaException(Exception):
 
     @property
     def status(self) -> HTTPStatus:
-        return self._status
\ No newline at end of file
+        return self._status
+
+
+class NoInstanceException(EurekaException):
+    """app没有可供选择的实例时抛出。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(HTTPStatus.SERVICE_UNAVAILABLE, *args, **kwargs)
@@ -0,0 +1,153 @@
+# -*- coding  :   utf-8 -*-
+# @Author     :   zhaojiangbing
+# @File       :   limiter.py
+# @Software   :   PyCharm
+
+
+"""实现客户端自适应并发限制。"""
+
+
+import asyncio
+import collections
+
+from http import HTTPStatus
+from .exc import EurekaException
+
+
+class LimitExceededException(EurekaException):
+    """并发数超过限制并且等待队列已满或者等待超时时抛出。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(HTTPStatus.SERVICE_UNAVAILABLE, *args, **kwargs)
+
+
+class AdaptiveLimiter(object):
+    """基于AIMD(加法增、乘法减)的自适应并发限制器。
+
+    延时的基线是历史延时的指数移动平均，跟随下游的正常延时变化，不用固定阈值。
+    请求成功并且延时不超过基线的latency_tolerance倍时，限制值加1/limit(每一轮约加1)；
+    请求失败或者延时超过基线的latency_tolerance倍时，限制值乘以backoff_ratio。
+    超过限制的请求进入有界等待队列，队列满了或者等待超时就快速拒绝。
+    """
+
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=1000, latency_tolerance=2,
+                 smoothing=0.05, backoff_ratio=0.9, max_queue=100, queue_timeout=1):
+        """
+        :param initial_limit: int，初始并发限制值。
+        :param min_limit: int，并发限制值的下限。
+        :param max_limit: int，并发限制值的上限。
+        :param latency_tolerance: float，请求延时超过延时基线的这么多倍就认为下游过载，必须大于1。
+        :param smoothing: float，延时基线指数移动平均的平滑系数，取值范围(0, 1]，越小基线变化越慢。
+        :param backoff_ratio: float，过载时限制值的缩小比例，取值范围(0, 1)。
+        :param max_queue: int，等待队列的最大长度，为0时超过限制立即拒绝。
+        :param queue_timeout: float，单位秒，在等待队列中的最长等待时间。
+        """
+
+        assert 0 < min_limit <= initial_limit <= max_limit, "limit must be 0 < min <= initial <= max"
+        assert 0 < backoff_ratio < 1, "backoff_ratio must be between 0 and 1"
+        assert latency_tolerance > 1, "latency_tolerance must be greater than 1"
+        assert 0 < smoothing <= 1, "smoothing must be between 0 and 1"
+        self._limit = float(initial_limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._latency_tolerance = latency_tolerance
+        self._smoothing = smoothing
+        self._baseline = None  # 延时基线，单位秒
+        self._backoff_ratio = backoff_ratio
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._waiters = collections.deque()  # 等待队列，存放future
+        self._rejected = 0  # 被拒绝的请求数
+        self._dropped = 0  # 失败或者超时的请求数
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    @property
+    def rejected(self):
+        return self._rejected
+
+    @property
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "queued": len(self._waiters),
+            "rejected": self._rejected,
+            "dropped": self._dropped,
+            "baseline_latency": self._baseline,
+        }
+
+    async def acquire(self):
+        """获取一个并发名额，获取不到会排队，队列满了或者等待超时抛出LimitExceededException。"""
+
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            return
+
+        if len(self._waiters) >= self._max_queue:
+            self._rejected += 1
+            raise LimitExceededException("concurrency limit {} exceeded, queue is full".format(self.limit))
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self._queue_timeout)  # 名额由release转交，in_flight已经加过
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                return  # 超时和release转交名额发生在同一轮事件循环，名额已经到手，按获取成功处理
+            self._rejected += 1
+            raise LimitExceededException("concurrency limit {} exceeded, wait timeout".format(self.limit))
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()  # 名额已经转交过来了，要还回去
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, latency, dropped=False):
+        """释放名额并根据本次请求的结果调整限制值。
+
+        :param latency: float，单位秒，本次请求的延时。
+        :param dropped: bool，本次请求是否失败(超时、连接错误、下游过载)。
+        :return:
+        """
+
+        if dropped:
+            self._dropped += 1
+            overloaded = True
+        else:
+            if self._baseline is None:
+                self._baseline = latency
+            overloaded = latency > self._baseline * self._latency_tolerance
+            self._baseline += self._smoothing * (latency - self._baseline)  # 更新延时基线
+
+        if overloaded:
+            self._limit = max(self._min_limit, self._limit * self._backoff_ratio)  # 乘法减
+        else:
+            self._limit = min(self._max_limit, self._limit + 1 / self._limit)  # 加法增
+        self._release_slot()
+
+    def cancel(self):
+        """调用方取消了请求，只释放名额，不调整限制值。"""
+
+        self._release_slot()
+
+    def _release_slot(self):
+        self._in_flight -= 1
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1  # 名额直接转交给等待者
+                waiter.set_result(None)
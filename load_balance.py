@@ -5,18 +5,45 @@
 """实现负载均衡。"""
 
 
+import hashlib
 import random
+import time
+
+from .exc import NoInstanceException
 
 
 class LoadBalance(object):
-    def __init__(self, app):
+    def __init__(self, app, slow_start_window=0, slow_start_min_ratio=0.1, zone=None,
+                 zone_min_healthy_ratio=0.7, zone_max_load=None, client_id=None, subset_size=None,
+                 panic_threshold=0.5):
         """
 
         :param app: App对象。
+        :param slow_start_window: int，单位秒，慢启动窗口，0表示不启用。
+        :param slow_start_min_ratio: float，慢启动开始时的权重比例。
+        :param zone: str，调用方所在的可用区，None表示不区分可用区。
+        :param zone_min_healthy_ratio: float，本可用区UP实例占比低于这个值时溢出到全部实例。
+        :param zone_max_load: float，本可用区实例平均在途请求数超过这个值时溢出到全部实例，None表示不检查。
+        :param client_id: int or str，客户端序号或者客户端id，决定本客户端分到哪些实例，见_subset。
+        :param subset_size: int，每个客户端使用的实例数，None表示使用全部实例。
+        :param panic_threshold: float，UP实例占比低于这个值时进入恐慌模式，使用全部实例。
         """
 
         self._app = app
         self._poll_count = 0
+        self._slow_start_window = slow_start_window
+        self._slow_start_min_ratio = slow_start_min_ratio
+        self._zone = zone
+        self._zone_min_healthy_ratio = zone_min_healthy_ratio
+        self._zone_max_load = zone_max_load
+        self._client_id = client_id
+        self._subset_size = subset_size
+        self._panic_threshold = panic_threshold
+        self._panic = False  # 是否处于恐慌模式
+        self._version = None  # 分组对应的app版本，版本变化才重新分组
+        self._all_instances = []  # 全部实例(开启子集时为子集)，按id排序
+        self._local_instances = []  # 本可用区的实例(开启子集时为子集)，按id排序
+        self._local_healthy = False  # 本可用区UP实例占比是否达到阈值
 
     def get_instance(self, instance_id):
         """获取本地实例。
@@ -28,26 +55,147 @@ class LoadBalance(object):
         instance = self._app._instances[instance_id]
         return instance
 
+    def _refresh(self):
+        """实例集合变化后重新计算分组，每次变化只计算一次，不在每次选择实例时计算。"""
+
+        self._version = self._app._version
+        instances = [self._app._instances[_id] for _id in sorted(self._app._instances.keys())]
+        up_instances = [instance for instance in instances if instance.is_up]
+        self._panic = bool(instances) and (not up_instances or
+                                           len(up_instances) / len(instances) < self._panic_threshold)
+
+        local = [instance for instance in instances if self._zone is not None and instance._zone == self._zone]
+        if local:
+            up = sum(1 for instance in local if instance.is_up)
+            self._local_healthy = up / len(local) >= self._zone_min_healthy_ratio
+        else:
+            self._local_healthy = False
+
+        # 子集按全部成员计算，和实例状态无关，实例上下线只影响它自己，不会让所有客户端的子集重新洗牌
+        self._all_instances = self._filter_up(self._subset(instances), instances)
+        self._local_instances = self._filter_up(self._subset(local), local)
+
+    def _filter_up(self, subset, group):
+        """在子集内过滤出UP的实例。
+
+        恐慌模式下不过滤状态；子集内没有UP实例时，退回到整个分组的UP实例。
+
+        :param subset: list，分组的子集。
+        :param group: list，完整的分组。
+        :return: list，按id排序的Instance对象列表。
+        """
+
+        if self._panic:
+            return subset
+        up_instances = [instance for instance in subset if instance.is_up]
+        if up_instances or subset is group:
+            return up_instances
+        return [instance for instance in group if instance.is_up]
+
+    def _subset(self, instances):
+        """按客户端id确定性地选出实例子集。
+
+        client_id为整数(客户端序号，0、1、2...连续分配)时，使用分轮洗牌的确定性子集划分：
+        每subset_count个客户端为一轮，每轮用轮号作种子洗牌实例列表并切成subset_count份，
+        客户端按序号取其中一份，所以每个实例分到的客户端数严格均衡，但实例增减时子集会整体变化。
+
+        client_id为字符串时，使用rendezvous hashing：对每个实例计算hash(client_id, instance_id)，
+        取最大的subset_size个，实例增减时只有涉及的实例进出子集，但各实例分到的客户端数只是
+        统计上接近(客户端多时仍有约±20%的偏差)。
+
+        :param instances: list，按id排序的Instance对象列表。
+        :return: list，按id排序的子集。
+        """
+
+        if self._subset_size is None or len(instances) <= self._subset_size:
+            return instances
+
+        if isinstance(self._client_id, int):
+            subset_count = len(instances) // self._subset_size
+            shuffled = list(instances)
+            random.Random(self._client_id // subset_count).shuffle(shuffled)  # 同一轮的客户端洗牌结果相同
+            start = (self._client_id % subset_count) * self._subset_size
+            subset = shuffled[start:start + self._subset_size]
+        else:
+            def score(instance):
+                key = "{}/{}".format(self._client_id, instance.instance_id).encode("utf-8")
+                return hashlib.md5(key).digest()  # 不能用hash()，它在不同进程间不稳定
+
+            subset = sorted(instances, key=score, reverse=True)[:self._subset_size]
+        return sorted(subset, key=lambda instance: instance.instance_id)
+
+    @property
+    def is_panic(self):
+        """UP实例太少，正在使用全部实例时为True。"""
+
+        if self._version != self._app._version:
+            self._refresh()
+        return self._panic
+
+    def get_candidates(self):
+        """获取本次可供选择的实例列表。
+
+        只返回状态为UP的实例(UP实例占比低于panic_threshold时返回全部实例)，
+        优先返回本可用区的实例，本可用区健康占比过低或者负载过高时溢出到全部实例。
+
+        :return: list，Instance对象列表。
+
+        没有任何实例可供选择时抛出NoInstanceException。
+        """
+
+        if self._version != self._app._version:
+            self._refresh()
+
+        if not self._all_instances:
+            raise NoInstanceException("app {} has no instance".format(self._app._name))
+        if not self._local_healthy or not self._local_instances:
+            return self._all_instances
+        if self._zone_max_load is not None:
+            load = sum(instance.active_requests for instance in self._local_instances) / len(self._local_instances)
+            if load > self._zone_max_load:
+                return self._all_instances
+        return self._local_instances
+
+    def get_weight(self, instance):
+        """获取实例的有效权重。
+
+        在慢启动窗口内，有效权重从weight * slow_start_min_ratio线性升到weight，
+        所有加权、感知负载的策略都要通过该方法获取权重。
+
+        :param instance: Instance对象。
+        :return: float
+        """
+
+        weight = float(instance._metadata["weight"])
+        if self._slow_start_window <= 0:
+            return weight
+
+        elapsed = max(0, time.time() - instance.start_time)
+        if elapsed >= self._slow_start_window:
+            return weight
+        ratio = self._slow_start_min_ratio + (1 - self._slow_start_min_ratio) * elapsed / self._slow_start_window
+        return weight * ratio
+
     def _random_get_instance(self):
         """随机获取instance。"""
 
-        instance_ids = sorted(self._app._instances.keys())  # 实时获取实例id列表并且排序
-        number = random.randint(0, len(instance_ids)-1)  # 随机选择一个number
+        instances = self.get_candidates()
+        number = random.randint(0, len(instances)-1)  # 随机选择一个number
 
-        instance = self.get_instance(instance_ids[number])
+        instance = instances[number]
         return instance
 
     def _poll_get_instance(self):
         """轮询获取instance。"""
 
-        instance_ids = sorted(self._app._instances.keys())  # 实时获取实例id列表并且排序
-        length = len(instance_ids)
+        instances = self.get_candidates()
+        length = len(instances)
         if self._poll_count >= length:
             self._poll_count = 0  # 清零
         number = self._poll_count % length  # 取模
         self._poll_count += 1
 
-        instance = self.get_instance(instance_ids[number])
+        instance = instances[number]
         return instance
 
     def _poll_weight_get_instance(self):
@@ -55,11 +203,11 @@ class LoadBalance(object):
 
         total = 0
         max_dynamic_weight_instance = None  # 用于记录动态权重最大的实例
-        for _id, instance in self._app._instances.items():
+        for instance in self.get_candidates():
             if max_dynamic_weight_instance is None:
                 max_dynamic_weight_instance = instance
 
-            weight = int(instance._metadata["weight"])
+            weight = self.get_weight(instance)
             instance.dynamic_weight += weight  # 修改动态权重值
 
             if instance.dynamic_weight > max_dynamic_weight_instance.dynamic_weight:
@@ -69,4 +217,4 @@ class LoadBalance(object):
 
         max_dynamic_weight_instance.dynamic_weight -= total  # 对选出实例的动态权重减去总权重
 
-        return max_dynamic_weight_instance
\ No newline at end of file
+        return max_dynamic_weight_instance
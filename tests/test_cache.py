@@ -0,0 +1,85 @@
+# -*- coding  :   utf-8 -*-
+# @Author     :   zhaojiangbing
+# @File       :   test_cache.py
+# @Software   :   PyCharm
+
+
+import asyncio
+import importlib
+import os
+import sys
+
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(_root))
+_package = os.path.basename(_root)  # 包内用的是相对导入
+cache = importlib.import_module(_package + ".cache")
+apps = importlib.import_module(_package + ".apps")
+
+
+def test_ttl_uses_max_age_not_s_maxage():
+    response_cache = cache.ResponseCache(default_ttl=1)
+    assert response_cache._get_ttl({"Cache-Control": "s-maxage=600, max-age=5"}) == 5
+    assert response_cache._get_ttl({"Cache-Control": "s-maxage=600"}) == 1
+    assert response_cache._get_ttl({"cache-control": "no-store"}) == 0
+
+
+class Response(object):
+    status = 200
+    headers = {"Cache-Control": "max-age=60"}
+
+    def __init__(self, calls):
+        self._calls = calls
+
+    async def __aenter__(self):
+        self._calls.append(1)
+        await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def text(self):
+        return "ok"
+
+
+class Session(object):
+    closed = False
+
+    def __init__(self):
+        self.calls = []
+
+    def request(self, **kwargs):
+        return Response(self.calls)
+
+
+class Driver(object):
+    def __init__(self, app):
+        self._app = app
+
+    async def get_app(self, app_name, is_remote=False):
+        return self._app
+
+
+def test_coalesced_gets_count_one_miss():
+    app = type("App", (), {})()
+    instance = type("Instance", (), {"_ip_addr": "10.0.0.1", "_port": 80, "active_requests": 0})()
+    app.load_balance = type("LoadBalance", (), {"_random_get_instance": lambda self: instance})()
+
+    async def main():
+        discover = apps.DiscoverApp(app_name="test", cache=cache.ResponseCache())
+        discover._driver = Driver(app)
+        session = Session()
+        discover._session = session
+        results = await asyncio.gather(*[discover.request("/path") for _ in range(20)])
+        assert results == [(200, "ok")] * 20
+        assert len(session.calls) == 1
+        stats = discover.cache.stats
+        assert stats["miss"] == 1
+        assert stats["coalesced"] == 19
+
+        assert await discover.request("/path") == (200, "ok")
+        assert discover.cache.stats["hit"] == 1
+        assert discover.cache.stats["miss"] == 1
+
+    asyncio.run(main())
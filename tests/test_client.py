@@ -0,0 +1,111 @@
+# -*- coding  :   utf-8 -*-
+# @Author     :   zhaojiangbing
+# @File       :   test_client.py
+# @Software   :   PyCharm
+
+
+import asyncio
+import importlib
+import os
+import sys
+
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(_root))
+client = importlib.import_module(os.path.basename(_root) + ".client")  # 包内用的是相对导入
+
+
+def test_register_many_after_deregister_many_registers_again():
+    async def main():
+        eureka = client.EurekaClient()
+        requests = []
+
+        async def do_req(url, method="GET", data=None, raise_exc=False):
+            requests.append(method)
+            return ""
+
+        async def heartbeat(instance):
+            pass
+
+        eureka._do_req = do_req
+        eureka._heartbeat = heartbeat
+        instance = eureka.create_app("test").create_instance(ip_addr="10.0.0.1", port=80, metadata={})
+
+        assert (await eureka.register_many([instance]))["succeeded"] == [instance.instance_id]
+        assert (await eureka.deregister_many([instance]))["succeeded"] == [instance.instance_id]
+        assert not instance._is_register
+        assert not instance._is_heartbeat
+
+        assert (await eureka.register_many([instance]))["succeeded"] == [instance.instance_id]
+        assert requests == ["POST", "DELETE", "POST"]
+        assert instance._is_register
+        assert instance._is_heartbeat
+
+    asyncio.run(main())
+
+
+def test_404_removes_instances_of_known_app_only():
+    async def main():
+        eureka = client.EurekaClient()
+        responses = {"known": {"application": {"instance": [{
+            "hostName": "h", "ipAddr": "10.0.0.1", "port": {"$": 80}, "instanceId": "i0", "metadata": {},
+            "leaseInfo": {"durationInSecs": 30, "renewalIntervalInSecs": 10}, "statusPageUrl": "s"}]}}}
+
+        async def do_req(url, method="GET", data=None, raise_exc=False):
+            app_name = url.split("/")[-1]
+            if app_name not in responses:
+                raise client.EurekaException(client.HTTPStatus.NOT_FOUND)
+            return responses[app_name]
+
+        eureka._do_req = do_req
+        eureka._not_add_long_poll = False  # 不启动长轮询
+
+        assert await eureka.get_app("typo") is None
+        assert "typo" not in eureka._apps
+
+        app = await eureka.get_app("known")
+        assert app.get_instance_ids() == ["i0"]
+        del responses["known"]
+        assert await eureka.get_app("known", is_remote=True) is app
+        assert app.get_instance_ids() == []
+
+    asyncio.run(main())
+
+
+def test_get_app_serves_stale_while_revalidate():
+    async def main():
+        eureka = client.EurekaClient(cache_ttl=10, cache_max_stale=100)
+        calls = []
+
+        async def do_req(url, method="GET", data=None, raise_exc=False):
+            calls.append(url)
+            await asyncio.sleep(0.01)
+            return {"application": {"instance": [{
+                "hostName": "h", "ipAddr": "10.0.0.1", "port": {"$": 80}, "instanceId": "i0", "metadata": {},
+                "leaseInfo": {"durationInSecs": 30, "renewalIntervalInSecs": 10}, "statusPageUrl": "s"}]}}
+
+        eureka._do_req = do_req
+        eureka._not_add_long_poll = False  # 不启动长轮询
+
+        app = await eureka.get_app("test")  # 本地没有，阻塞获取
+        assert len(calls) == 1
+
+        await asyncio.gather(*[eureka.get_app("test") for _ in range(5)])  # 新鲜
+        assert len(calls) == 1
+        assert eureka.cache_stats["counts"]["fresh"] == 5
+
+        app._fetched_at -= 50  # 陈旧
+        results = await asyncio.gather(*[eureka.get_app("test") for _ in range(5)])
+        assert results == [app] * 5
+        assert eureka.cache_stats["refreshing"] == ["test"]  # 直接返回，没等刷新完成
+        await eureka._refreshing["test"]
+        assert len(calls) == 2  # 5个陈旧读取只刷新一次
+        assert eureka.get_cache_age("test") < 10
+
+        app._fetched_at -= 500  # 超过最大陈旧时间
+        await eureka.get_app("test")
+        assert len(calls) == 3
+        assert eureka.get_cache_age("test") < 10
+        assert eureka.cache_stats["counts"] == {"miss": 1, "fresh": 5, "stale": 5, "blocking": 1}
+
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+# -*- coding  :   utf-8 -*-
+# @Author     :   zhaojiangbing
+# @File       :   test_limiter.py
+# @Software   :   PyCharm
+
+
+import asyncio
+import importlib
+import os
+import sys
+
+import pytest
+
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(_root))
+limiter = importlib.import_module(os.path.basename(_root) + ".limiter")  # 包内用的是相对导入
+
+
+def test_acquire_keeps_slot_handed_over_when_timeout_fires(monkeypatch):
+    """release转交名额和排队超时发生在同一轮事件循环时，名额不能泄漏。"""
+
+    async def main():
+        lim = limiter.AdaptiveLimiter(initial_limit=1, max_limit=1, max_queue=1, queue_timeout=1)
+        await lim.acquire()  # 占满名额
+
+        async def wait_for(waiter, timeout):
+            lim.release(0)  # 名额转交给waiter
+            raise asyncio.TimeoutError()  # 同一轮里超时回调也触发了
+
+        monkeypatch.setattr(limiter.asyncio, "wait_for", wait_for)
+        await lim.acquire()  # 名额已经到手，不应该被拒绝
+        assert lim.stats["in_flight"] == 1
+        assert lim.rejected == 0
+
+        lim.release(0)
+        assert lim.stats["in_flight"] == 0
+        assert lim.stats["queued"] == 0
+
+    asyncio.run(main())
+
+
+def test_acquire_rejects_when_queue_is_full():
+    async def main():
+        lim = limiter.AdaptiveLimiter(initial_limit=1, max_limit=1, max_queue=0)
+        await lim.acquire()
+        with pytest.raises(limiter.LimitExceededException):
+            await lim.acquire()
+        assert lim.rejected == 1
+        assert lim.in_flight == 1
+
+    asyncio.run(main())
+
+
+def test_steady_slow_backend_is_not_treated_as_overloaded():
+    async def main():
+        lim = limiter.AdaptiveLimiter(initial_limit=20)
+        for _ in range(200):
+            await lim.acquire()
+            lim.release(1.5)  # 健康但是慢的下游
+        assert lim.limit >= 20
+        assert lim.rejected == 0
+
+    asyncio.run(main())
+
+
+def test_latency_spike_over_baseline_shrinks_limit():
+    async def main():
+        lim = limiter.AdaptiveLimiter(initial_limit=20)
+        for _ in range(10):
+            await lim.acquire()
+            lim.release(0.1)
+        limit = lim.limit
+        await lim.acquire()
+        lim.release(1)  # 超过基线的2倍
+        assert lim.limit < limit
+
+    asyncio.run(main())
+
+
+def test_cancel_releases_slot_without_backoff():
+    async def main():
+        lim = limiter.AdaptiveLimiter(initial_limit=5)
+        await lim.acquire()
+        lim.cancel()
+        assert lim.in_flight == 0
+        assert lim.limit == 5
+        assert lim.stats["dropped"] == 0
+
+    asyncio.run(main())
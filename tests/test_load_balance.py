@@ -0,0 +1,152 @@
+# -*- coding  :   utf-8 -*-
+# @Author     :   zhaojiangbing
+# @File       :   test_load_balance.py
+# @Software   :   PyCharm
+
+
+import importlib
+import os
+import sys
+import time
+
+import pytest
+
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(_root))
+_package = os.path.basename(_root)  # 包内用的是相对导入
+application = importlib.import_module(_package + ".application")
+exc = importlib.import_module(_package + ".exc")
+
+
+class Author(object):
+    """代替EurekaClient，只提供创建App需要的属性。"""
+
+    _zone_metadata_key = "zone"
+
+    def __init__(self, **load_balance_options):
+        self._load_balance_options = load_balance_options
+
+
+def create_app(count, status="UP", **load_balance_options):
+    app = application.App(Author(**load_balance_options), "test")
+    for i in range(count):
+        app.create_instance(instance_id="i{}".format(i), ip_addr="10.0.0.{}".format(i), port=80,
+                            metadata={}, status=status)
+    return app
+
+
+def test_all_down_falls_back_to_all_instances():
+    app = create_app(3, status="DOWN", panic_threshold=0)
+    assert app.load_balance.is_panic
+    assert len(app.load_balance.get_candidates()) == 3
+
+
+@pytest.mark.parametrize("strategy", ["_random_get_instance", "_poll_get_instance", "_poll_weight_get_instance"])
+def test_no_instance_raises(strategy):
+    app = create_app(0)
+    with pytest.raises(exc.NoInstanceException):
+        getattr(app.load_balance, strategy)()
+
+
+def test_subset_with_client_index_is_balanced():
+    counts = {}
+    for client_index in range(1000):
+        app = create_app(100, client_id=client_index, subset_size=10)
+        subset = app.load_balance.get_candidates()
+        assert len(subset) == 10
+        for instance in subset:
+            counts[instance.instance_id] = counts.get(instance.instance_id, 0) + 1
+    assert set(counts.values()) == {100}
+
+
+def test_subset_with_client_name_is_stable_when_instance_removed():
+    app = create_app(50, client_id="host-a", subset_size=5)
+    before = {instance.instance_id for instance in app.load_balance.get_candidates()}
+    app.remove_instance(app._instances[sorted(before)[0]])
+    after = {instance.instance_id for instance in app.load_balance.get_candidates()}
+    assert len(before - after) == 1
+    assert len(after) == 5
+
+
+def test_slow_start_ramps_linearly_from_min_ratio():
+    app = create_app(1, slow_start_window=100, slow_start_min_ratio=0.2)
+    instance = app._instances["i0"]
+    instance._metadata["weight"] = 10
+    instance._registration_timestamp = time.time() - 50
+    assert app.load_balance.get_weight(instance) == pytest.approx(6, abs=0.01)
+
+
+def test_slow_start_ignores_registration_timestamp_in_the_future():
+    app = create_app(1, slow_start_window=100, slow_start_min_ratio=0.2)
+    instance = app._instances["i0"]
+    instance._registration_timestamp = time.time() + 3600
+    assert instance.start_time == instance._first_seen
+    assert app.load_balance.get_weight(instance) == pytest.approx(0.2, abs=0.01)
+
+
+def test_update_instance_bumps_version_only_on_routing_change():
+    app = create_app(1)
+    version = app._version
+    app.update_instance("i0", metadata={"weight": 1}, status="UP", lease_duration=60)
+    assert app._version == version
+    app.update_instance("i0", status="DOWN")
+    assert app._version == version + 1
+    app.update_instance("i0", metadata={"weight": 3})
+    assert app._version == version + 2
+
+
+def test_subset_with_client_index_is_stable_when_other_instance_goes_down():
+    app = create_app(100, client_id=7, subset_size=10)
+    before = [instance.instance_id for instance in app.load_balance.get_candidates()]
+    outsider = next(_id for _id in sorted(app._instances) if _id not in before)
+    member = before[0]
+
+    app.update_instance(outsider, status="DOWN")
+    assert [instance.instance_id for instance in app.load_balance.get_candidates()] == before
+
+    app.update_instance(member, status="DOWN")
+    assert [instance.instance_id for instance in app.load_balance.get_candidates()] == before[1:]
+
+
+def create_zoned_app(zones, **load_balance_options):
+    app = application.App(Author(zone="a", **load_balance_options), "test")
+    for i, zone in enumerate(zones):
+        app.create_instance(instance_id="i{}".format(i), ip_addr="10.0.0.{}".format(i), port=80,
+                            metadata={}, zone=zone)
+    return app
+
+
+def candidate_ids(app):
+    return [instance.instance_id for instance in app.load_balance.get_candidates()]
+
+
+def test_zone_routes_to_local_instances_only():
+    app = create_zoned_app(["a", "a", "b", "b"])
+    assert candidate_ids(app) == ["i0", "i1"]
+    assert {app.load_balance._poll_get_instance().instance_id for _ in range(10)} == {"i0", "i1"}
+
+
+def test_zone_spills_over_when_local_healthy_ratio_is_low():
+    app = create_zoned_app(["a", "a", "b", "b", "b", "b"], zone_min_healthy_ratio=0.7)
+    app.update_instance("i0", status="DOWN")  # 本可用区只有50%是UP
+    assert candidate_ids(app) == ["i1", "i2", "i3", "i4", "i5"]
+
+
+def test_zone_spills_over_when_local_load_is_high():
+    app = create_zoned_app(["a", "a", "b"], zone_max_load=2)
+    assert candidate_ids(app) == ["i0", "i1"]
+    app._instances["i0"].active_requests = 3
+    app._instances["i1"].active_requests = 2  # 平均2.5，超过2
+    assert candidate_ids(app) == ["i0", "i1", "i2"]
+    app._instances["i0"].active_requests = 1
+    assert candidate_ids(app) == ["i0", "i1"]
+
+
+def test_parse_zone_from_metadata_and_data_center_info():
+    app = create_app(0)
+    info = {"metadata": {}, "dataCenterInfo": {"name": "Amazon", "metadata": {"availability-zone": "us-east-1a"}}}
+    assert app._parse_zone(info) == "us-east-1a"
+    info["metadata"]["zone"] = "custom"
+    assert app._parse_zone(info) == "custom"
+    assert app._parse_zone({"metadata": {}, "dataCenterInfo": {"name": "MyOwn"}}) is None